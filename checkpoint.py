@@ -0,0 +1,237 @@
+import hashlib
+import os
+import sys
+from collections import Counter
+
+import numpy as np
+
+from data_utils import Lexicon, LexiconEntry, Tag
+
+CHECKPOINT_VERSION = 1
+
+
+def corpus_fingerprint(records) -> str:
+    """
+    Hash of the ids and tokens of the given records, used to check that a checkpoint belongs to a corpus.
+
+    :param records: list of records
+    :return: hexadecimal digest
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for record in records:
+        h.update(repr(record.id).encode('utf-8'))
+        for line in record.tokens:
+            h.update(b'\x1e' + '\x1f'.join(line).encode('utf-8', 'surrogatepass'))
+        h.update(b'\x1d')
+
+    return h.hexdigest()
+
+
+def save_checkpoint(finder, path):
+    """
+    Save the full state of a CandidateFinder: lexicon, rejected entries, positional counters, filtered contexts,
+    pointwise mutual information, and candidate ranking.
+    The pointwise mutual information is left out if it has not been computed or loaded yet.
+    All strings are stored once in a vocabulary and everything else as arrays of vocabulary ids.
+    The file is written next to the target first and then moved in place, so an interrupted save never leaves a
+    broken checkpoint behind.
+
+    :param finder: CandidateFinder object
+    :param path: checkpoint file location
+    """
+    vocab = {}
+    arrays = {
+        'version': np.array(CHECKPOINT_VERSION),
+        'window': np.array(finder.window),
+        'fingerprint': np.array(corpus_fingerprint(finder.records)),
+    }
+
+    entries = list(finder.lexicon.values()) if finder.lexicon is not None else []
+    arrays['lexicon'], arrays['lexicon_lengths'] = _encode_sequences([e.entry for e in entries], vocab)
+    arrays['lexicon_raw'] = np.array([_intern(e.raw, vocab) for e in entries], dtype=np.int64)
+    arrays['lexicon_classes'] = np.array([Tag.CODES[e.class_] for e in entries], dtype=np.int8)
+    arrays['lexicon_parents'], arrays['lexicon_parent_lengths'] = _encode_sequences([e.parent for e in entries], vocab)
+    arrays['lexicon_numbers'], arrays['lexicon_number_lengths'] = _encode_sequences([e.numbers for e in entries], vocab)
+    arrays['rejected'], arrays['rejected_lengths'] = _encode_sequences(list(finder.rejected), vocab)
+
+    for name in ('pos_counter', 'pos_counter_m'):
+        counter = getattr(finder, name)
+        if counter is not None:
+            arrays[name] = np.array([(i, _intern(e, vocab), c) for (i, e), c in counter.items()],
+                                    dtype=np.int64).reshape(-1, 3)
+
+    if finder.contexts is not None:
+        arrays['contexts'] = np.array([[_intern(t, vocab) for t in c] for c in finder.contexts],
+                                      dtype=np.int64).reshape(-1, 2 * finder.window)
+        arrays['context_counts'] = np.array(list(finder.contexts.values()), dtype=np.int64)
+
+    arrays['candidates'], arrays['candidate_lengths'] = _encode_sequences([c for c, _ in finder.candidates], vocab)
+    arrays['candidate_counts'] = np.array([n for _, n in finder.candidates], dtype=np.int64)
+
+    # computing the pointwise mutual information takes a full pass over the records
+    loader = finder._loaders.get('pmi')
+    if loader is None or isinstance(loader, _Loader):
+        pairs = [(_intern(w1, vocab), _intern(w2, vocab), pmi)
+                 for w1 in finder.pmi for w2, pmi in finder.pmi[w1].items()]
+        arrays['pmi'] = np.array([p[:2] for p in pairs], dtype=np.int64).reshape(-1, 2)
+        arrays['pmi_values'] = np.array([p[2] for p in pairs], dtype=np.float64)
+
+    encoded = [s.encode('utf-8', 'surrogatepass') for s in vocab]
+    arrays['vocab'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    arrays['vocab_lengths'] = np.array([len(s) for s in encoded], dtype=np.int64)
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as file:
+        np.savez_compressed(file, **arrays)
+    os.replace(tmp, path)
+
+
+def load_checkpoint(finder, path, validate=True):
+    """
+    Restore the state saved by save_checkpoint into a CandidateFinder.
+    The lexicon and rejected entries are restored immediately, the statistics and candidates are read from the file
+    and decoded on first use.
+
+    :param finder: CandidateFinder object, created with the records the checkpoint was built from
+    :param path: checkpoint file location
+    :param validate: check that the checkpoint was built from the records of the finder
+    """
+    file = _CheckpointFile(path)
+    try:
+        arrays = file.data
+        if int(arrays['version']) != CHECKPOINT_VERSION:
+            raise ValueError(f'Unsupported checkpoint version {int(arrays["version"])}, expected {CHECKPOINT_VERSION}')
+        if validate and str(arrays['fingerprint']) != corpus_fingerprint(finder.records):
+            raise ValueError(f'Checkpoint {path} was built from a different corpus')
+
+        blob = arrays['vocab'].tobytes()
+        ends = np.cumsum(arrays['vocab_lengths']).tolist()
+        vocab = [sys.intern(blob[s:e].decode('utf-8', 'surrogatepass')) for s, e in zip([0] + ends, ends)]
+
+        finder.window = int(arrays['window'])
+        entries = _decode_sequences(arrays['lexicon'], arrays['lexicon_lengths'], vocab)
+        parents = _decode_sequences(arrays['lexicon_parents'], arrays['lexicon_parent_lengths'], vocab)
+        numbers = _decode_sequences(arrays['lexicon_numbers'], arrays['lexicon_number_lengths'], vocab)
+        finder.lexicon = Lexicon(
+            (entry, LexiconEntry(entry, vocab[raw], numbers=list(nums) if nums is not None else None,
+                                 class_=Tag.CLASSES[code], parent=parent))
+            for entry, raw, code, parent, nums in zip(entries, arrays['lexicon_raw'].tolist(),
+                                                      arrays['lexicon_classes'].tolist(), parents, numbers))
+        finder.rejected = set(_decode_sequences(arrays['rejected'], arrays['rejected_lengths'], vocab))
+    except Exception:
+        file.data.close()
+        raise
+
+    # statistics that had not been computed yet are not in the checkpoint
+    for name in ('pos_counter', 'pos_counter_m'):
+        if name in arrays:
+            finder.lazy(name, file.loader(_decode_counter, vocab, name))
+        else:
+            setattr(finder, name, None)
+    if 'contexts' in arrays:
+        finder.lazy('contexts', file.loader(_decode_contexts, vocab, 'contexts', 'context_counts'))
+    else:
+        finder.contexts = None
+    finder.lazy('candidates', file.loader(_decode_candidates, vocab, 'candidates', 'candidate_lengths',
+                                          'candidate_counts'))
+    # without a saved pmi the finder keeps computing it from the records
+    if 'pmi' in arrays:
+        finder.lazy('pmi', file.loader(_decode_pmi, vocab, 'pmi', 'pmi_values'))
+    file.release()
+
+
+class _CheckpointFile:
+    def __init__(self, path):
+        """
+        Open checkpoint file, the arrays are only read and decompressed by the loaders that use them.
+        The file is closed when the last loader has run.
+
+        :param path: checkpoint file location
+        """
+        self.data = np.load(path)
+        self.pending = 1  # released at the end of load_checkpoint
+
+    def loader(self, decode, vocab, *names):
+        self.pending += 1
+        return _Loader(self, decode, vocab, names)
+
+    def release(self):
+        self.pending -= 1
+        if not self.pending:
+            self.data.close()
+
+
+class _Loader:
+    def __init__(self, file, decode, vocab, names):
+        """
+        Lazy attribute loader, see CandidateFinder.lazy.
+
+        :param file: _CheckpointFile to read from
+        :param decode: function that decodes the arrays with the vocabulary
+        :param vocab: list of strings
+        :param names: names of the arrays to pass to decode
+        """
+        self.file = file
+        self.decode = decode
+        self.vocab = vocab
+        self.names = names
+
+    def __call__(self):
+        try:
+            return self.decode(*(self.file.data[name] for name in self.names), self.vocab)
+        finally:
+            self.file.release()
+
+
+def _intern(s, vocab) -> int:
+    return vocab.setdefault(s, len(vocab))
+
+
+def _encode_sequences(sequences, vocab) -> tuple:
+    """
+    :param sequences: list of sequences of strings, or None
+    :param vocab: {string: id} vocabulary to add the strings to
+    :return: flat array of string ids, array of sequence lengths (-1 for None)
+    """
+    flat = [_intern(s, vocab) for seq in sequences if seq is not None for s in seq]
+    lengths = [len(seq) if seq is not None else -1 for seq in sequences]
+
+    return np.array(flat, dtype=np.int64), np.array(lengths, dtype=np.int64)
+
+
+def _decode_sequences(flat, lengths, vocab) -> list:
+    """
+    :return: list of tuples of strings, or None, as encoded by _encode_sequences
+    """
+    flat = [vocab[i] for i in flat.tolist()]
+    sequences = []
+    start = 0
+    for n in lengths.tolist():
+        if n < 0:
+            sequences.append(None)
+        else:
+            sequences.append(tuple(flat[start:start + n]))
+            start += n
+
+    return sequences
+
+
+def _decode_counter(counts, vocab) -> Counter:
+    return Counter({(i, vocab[e]): c for i, e, c in counts.tolist()})
+
+
+def _decode_contexts(contexts, counts, vocab) -> dict:
+    tokens = np.array(vocab, dtype=object)[contexts].tolist()
+    return {tuple(c): n for c, n in zip(tokens, counts.tolist())}
+
+
+def _decode_candidates(candidates, lengths, counts, vocab) -> list:
+    return list(zip(_decode_sequences(candidates, lengths, vocab), counts.tolist()))
+
+
+def _decode_pmi(pairs, values, vocab) -> dict:
+    pmi = {}
+    for (w1, w2), value in zip(pairs.tolist(), values.tolist()):
+        pmi.setdefault(vocab[w1], {})[vocab[w2]] = value
+
+    return pmi
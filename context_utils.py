@@ -1,7 +1,14 @@
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from heapq import nlargest
+from itertools import islice
+from operator import itemgetter
+import threading
 
 from fuzzy import get_fuzzy_matches, get_fuzzy_matches_multi, calculate_pmi
 from data_utils import LexiconEntry, Tag, get_wd
+from checkpoint import save_checkpoint, load_checkpoint
+import os
 import pickle
 from gui import ReviewGUI
 
@@ -26,20 +33,128 @@ def get_at_n(tokens, line, pos, n, lexicon=()):
         return tok if tok not in lexicon else 'M'
 
 
+def build_masked_view(tokens, lexicon=(), window=3) -> list:
+    """
+    Builds a lexicon-masked view of the tokenized lines of a record.
+    Tokens contained in the lexicon are replaced by 'M' and every line is padded with window neighbouring tokens
+    on both sides, as returned by get_at_n, so the context of any token span can be obtained by slicing.
+
+    :param tokens: list of lists of tokens
+    :param lexicon: lexicon used for masking
+    :param window: context window size
+    :return: list of padded lines, the token at position pos of a line is found at index pos + window
+    """
+    empty = '' if '' not in lexicon else 'M'
+    masked = [[tok if tok not in lexicon else 'M' for tok in line] for line in tokens]
+    view = []
+    for ln, line in enumerate(masked):
+        if ln == 0:
+            left = [''] * window
+        else:
+            prev = masked[ln - 1]
+            left = [prev[n] if -n <= len(prev) else empty for n in range(-window, 0)]
+
+        if ln + 1 == len(masked):
+            right = [''] * window
+        else:
+            nxt = masked[ln + 1]
+            right = [nxt[n] if n < len(nxt) else empty for n in range(window)]
+
+        view.append(left + line + right)
+
+    return view
+
+
+def get_masked_view(record, lexicon=(), window=3) -> list:
+    """
+    Returns the lexicon-masked view of a record as built by build_masked_view.
+    The view is cached on the record and rebuilt when the lexicon version or window size changes.
+    Lexicons without a version (e.g. plain dicts) are never cached.
+
+    :param record: record object
+    :param lexicon: lexicon used for masking
+    :param window: context window size
+    :return: list of padded lines
+    """
+    version = getattr(lexicon, 'version', None)
+    cached = getattr(record, 'view', None)
+    if version is not None and cached is not None and cached[0] == (version, window):
+        return cached[1]
+
+    view = build_masked_view(record.tokens, lexicon, window)
+    if version is not None:
+        record.view = ((version, window), view)
+
+    return view
+
+
+def get_context(line, pos, n, window=3) -> tuple:
+    """
+    Get the context surrounding a token span from a padded line of a masked view.
+
+    :param line: padded line as returned by build_masked_view
+    :param pos: position of the first token of the span in the unpadded line
+    :param n: position of the last token of the span relative to the first
+    :param window: context window size the view was built with
+    :return: tuple of window tokens left of the span followed by window tokens right of the span
+    """
+    return tuple(line[pos:pos + window] + line[pos + n + window + 1:pos + n + 2 * window + 1])
+
+
+class _Lazy:
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        """
+        Attribute that is computed by a loader function on first access, see CandidateFinder.lazy.
+        """
+        if obj is None:
+            return self
+        loader = obj._loaders.pop(self.name, None)
+        if loader is not None:
+            obj.__dict__[self.name] = loader()
+
+        return obj.__dict__[self.name]
+
+    def __set__(self, obj, value):
+        obj._loaders.pop(self.name, None)
+        obj.__dict__[self.name] = value
+
+
 class CandidateFinder:
+    words = _Lazy()
+    pmi = _Lazy()
+    candidates = _Lazy()
+    contexts = _Lazy()
+    pos_counter = _Lazy()
+    pos_counter_m = _Lazy()
+
     def __init__(self, records, lexicon=None, window=3, rejected=None):
+        self._loaders = {}
         self.records = records
-        self.words = list({word for record in records for sentence in record.tokens for word in sentence if len(word) > 1})
-        self.pmi = calculate_pmi(records)
+        self.lazy('words', lambda: list({word for record in records for sentence in record.tokens for word in sentence
+                                         if len(word) > 1}))
+        self.lazy('pmi', lambda: calculate_pmi(records))
         self.lexicon = lexicon
         self.window = window
         self.candidates = []
         self.contexts = None
         self.pos_counter = None
         self.pos_counter_m = None
+        self.stream = None
         if not rejected:
             self.rejected = set()
 
+    def lazy(self, name, loader) -> None:
+        """
+        Compute an attribute with the given loader function the first time it is used.
+
+        :param name: attribute name, one of words, pmi, candidates, contexts, pos_counter, or pos_counter_m
+        :param loader: function without arguments that returns the attribute value
+        """
+        self._loaders[name] = loader
+
     def _score_context(self, context) -> float:
         """
         Calculates the partial match score as described in the paper.
@@ -61,10 +176,12 @@ class CandidateFinder:
         :param partial: partial match threshold
         :param min_count: minimum occurrence count to keep a context
         """
+        self._reset_stream()
         gc = Counter()  # global context counter
         contexts = Counter()  # match context counter
         for record in self.records:
             tokens = record.tokens
+            view = get_masked_view(record, self.lexicon, self.window)
             for ln, line in enumerate(tokens):
                 for i, w in enumerate(line):
                     # look at up to 3 tokens in the middle
@@ -72,9 +189,8 @@ class CandidateFinder:
                         # stop if a sentence boundary is reached or there is a 1 character token
                         if i + l >= len(tokens[ln]) or len(tokens[ln][i + l]) < 2:
                             break
-                        toks = tuple(line[i + m] for m in range(l + 1))  # tokens in the middle
-                        tpl = tuple([get_at_n(tokens, ln, i if k < 0 else i + l, k, self.lexicon) for k in
-                                     range(-self.window, self.window + 1) if k != 0])  # context surrounding the tokens
+                        toks = tuple(line[i:i + l + 1])  # tokens in the middle
+                        tpl = get_context(view[ln], i, l, self.window)  # context surrounding the tokens
                         gc[tpl] += 1
                         if toks in self.lexicon:
                             contexts[tpl] += 1
@@ -114,65 +230,122 @@ class CandidateFinder:
 
         :return: list of (candidate, context) tuples
         """
+        self._reset_stream()
         candidates = []
         cdc = Counter()
         for record in self.records:
-            tokens = record.tokens
-            for line in range(len(tokens)):
-                for pos in range(len(tokens[line])):
-                    tok = tokens[line][pos]
-                    if len(tok) < 2 or tok in self.lexicon:
-                        continue
-
-                    # look at up to 3 tokens in the middle
-                    for l in range(3):
-                        # stop if a sentence boundary is reached or there is a 1 character token
-                        if pos + l >= len(tokens[line]) or len(tokens[line][pos + l]) < 2:
-                            break
-
-                        tpl = tuple([get_at_n(tokens, line, pos if k < 0 else pos + l, k, self.lexicon) for k in
-                                     range(-self.window, self.window + 1) if k != 0])  # context
-                        if tpl in self.contexts:
-                            candidate = tuple([get_at_n(tokens, line, pos, x) for x in range(0, l + 1)])
-                            if candidate in self.lexicon:
-                                continue
-                            candidates.append((candidate, tpl))
-                            cdc[candidate] += 1
+            for candidate, tpl, _, _ in self._record_candidates(record):
+                candidates.append((candidate, tpl))
+                cdc[candidate] += 1
 
         self.candidates = sorted(cdc.items(), key=lambda x: x[1], reverse=True)
 
         return candidates
 
-    def extend_fuzzy(self, thresh=0.85, pmi_thresh=7, multi_thresh=0.85, n=2) -> None:
+    def _record_candidates(self, record):
         """
-        Extend the lexicon with new fuzzy matches.
+        Finds the candidate entries of a single record, see get_candidates.
+
+        :param record: record object
+        :return: generator of (candidate, context, line, position) tuples
+        """
+        tokens = record.tokens
+        view = get_masked_view(record, self.lexicon, self.window)
+        for line in range(len(tokens)):
+            for pos in range(len(tokens[line])):
+                tok = tokens[line][pos]
+                if len(tok) < 2 or tok in self.lexicon:
+                    continue
+
+                # look at up to 3 tokens in the middle
+                for l in range(3):
+                    # stop if a sentence boundary is reached or there is a 1 character token
+                    if pos + l >= len(tokens[line]) or len(tokens[line][pos + l]) < 2:
+                        break
+
+                    tpl = get_context(view[line], pos, l, self.window)  # context
+                    if tpl in self.contexts:
+                        candidate = tuple(tokens[line][pos:pos + l + 1])
+                        if candidate in self.lexicon:
+                            continue
+                        yield candidate, tpl, line, pos
+
+    def get_fuzzy_entries(self, thresh=0.85, pmi_thresh=7, multi_thresh=0.85) -> dict:
+        """
+        Find fuzzy matches of the lexicon entries that are not in the lexicon yet.
+
+        :param thresh: cosine similarity threshold for single-token matches
+        :param pmi_thresh: pointwise mutual information threshold for multi-token matches
+        :param multi_thresh: cosine similarity threshold for multi-token matches
+        :return: {(tokens): LexiconEntry} dictionary of new fuzzy entries
         """
         lexicon_entries = [' '.join(e) for e in self.lexicon.keys()]
         matches = get_fuzzy_matches(self.words, lexicon_entries, n=2, lower_bound=thresh)
         matches += get_fuzzy_matches_multi(self.records, self.lexicon, self.pmi, pmi_bound=pmi_thresh, n=2, lower_bound=multi_thresh)
+        entries = {}
         for match, entry, val in matches:
             new = tuple(match.split())
-            if new not in self.lexicon:
-                self.lexicon[new] = LexiconEntry(new, match, class_=Tag.FUZ, parent=tuple(entry.split()))
+            if new not in self.lexicon and new not in entries:
+                entries[new] = LexiconEntry(new, match, class_=Tag.FUZ, parent=tuple(entry.split()))
+
+        return entries
+
+    def extend_fuzzy(self, thresh=0.85, pmi_thresh=7, multi_thresh=0.85, n=2) -> None:
+        """
+        Extend the lexicon with new fuzzy matches.
+        """
+        self._reset_stream()
+        self.lexicon.update(self.get_fuzzy_entries(thresh, pmi_thresh, multi_thresh))
 
-    def start_review(self, candidates=None, steps=20, n=250) -> None:
+    def start_review(self, candidates=None, steps=20, n=250, examples=3) -> None:
         """
         Start the GUI for a review session.
         Right mouse button marks a candidate as match (red), ambiguous (purple), or rejected (black, default).
         All non-marked (black) candidates are added to the rejects list.
+        Every candidate is shown with example contexts, which are searched in the background while reviewing.
+        If get_candidates has not been called, the candidates themselves are searched in the background as well and
+        the review starts immediately.
 
         :param candidates: list of candidates to review
         :param steps: number of candidates to show at a time
         :param n: maximum number of candidates to review
+        :param examples: number of example contexts per candidate
         """
-        if not candidates:
-            candidates = [c[0] for c in self.candidates[:n]]
-        gui = ReviewGUI(candidates, self.rejected, steps=steps)
+        if candidates:
+            # occurrence counts are known for candidates found by get_candidates only
+            counts = dict(self.candidates or ())
+            stream = CandidateStream(self, examples=examples, candidates=[(c, counts.get(c)) for c in candidates])
+        else:
+            if self.stream is None:
+                if not self.candidates and self.contexts is None:
+                    raise ValueError('process_contexts has to be called before searching for candidates')
+                self.stream = CandidateStream(self, examples=examples, candidates=self.candidates or None)
+            stream = self.stream
+
+        try:
+            gui = ReviewGUI([], self.rejected, steps=steps, stream=stream, n=n)
+        finally:
+            if stream is not self.stream:
+                stream.stop()
         self.rejected = gui.rejects
-        self.candidates = self.candidates[n:]
         for mat, cls in gui.matches:
             self.lexicon[mat] = LexiconEntry(mat, ' '.join(mat), class_=cls)
 
+        if stream.error is not None:
+            if stream is self.stream:
+                self.stream = None
+            raise stream.error
+        if stream is self.stream and (stream.done or stream.given):
+            self.candidates = stream.ranking(exclude=self.rejected)
+
+    def _reset_stream(self):
+        """
+        Stop and drop the background candidate search, its results are no longer valid.
+        """
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream = None
+
     def save_lexicon(self, path=get_wd() + '/data/lexicon.pickle'):
         with open(path, 'wb') as file:
             pickle.dump(self.lexicon, file)
@@ -197,12 +370,179 @@ class CandidateFinder:
         with open(path, 'rb') as file:
             self.pos_counter, self.pos_counter_m = pickle.load(file)
 
-    def save_all(self):
-        self.save_lexicon()
-        self.save_pos_stats()
-        self.save_rejected()
+    def save_all(self, path=get_wd() + '/data/finder.npz'):
+        """
+        Save a checkpoint of the full finder state, see checkpoint.save_checkpoint.
+
+        :param path: checkpoint file location
+        """
+        save_checkpoint(self, path)
+
+    def load_all(self, path=get_wd() + '/data/finder.npz', validate=True):
+        """
+        Resume from a checkpoint saved by save_all, see checkpoint.load_checkpoint.
+        Falls back to the separate pickle files written by earlier versions if there is no checkpoint.
+
+        :param path: checkpoint file location
+        :param validate: check that the checkpoint was built from the records of this finder
+        """
+        if not os.path.exists(path) and os.path.exists(get_wd() + '/data/lexicon.pickle'):
+            self.load_lexicon()
+            self.load_pos_stats()
+            self.load_rejected()
+            return
+
+        load_checkpoint(self, path, validate=validate)
+
+
+class CandidateStream:
+    def __init__(self, finder, examples=3, chunk_size=50, candidates=None):
+        """
+        Searches the candidates of a CandidateFinder in a background thread, see CandidateFinder.get_candidates.
+        The candidates found so far, and example contexts for them, can be requested while the search is running.
+        If the candidates are given, only their example contexts are searched in the background.
+
+        :param finder: CandidateFinder object, with processed contexts if no candidates are given
+        :param examples: number of example contexts to keep per candidate
+        :param chunk_size: number of records to search between updates
+        :param candidates: optional list of (candidate, count) tuples, e.g. as set by CandidateFinder.get_candidates,
+            the candidates keep this order and a count may be None if it is not known
+        """
+        self.finder = finder
+        self.examples = examples
+        self.chunk_size = chunk_size
+        self.counts = dict(candidates) if candidates is not None else Counter()
+        self.order = [c for c, _ in candidates] if candidates is not None else None
+        self.contexts = {}
+        self.given = candidates is not None
+        self.done = False
+        self.error = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            if self.given:
+                self._find_examples()
+            else:
+                self._search()
+            self.done = not self._stop.is_set()
+        except Exception as e:
+            # keep the error for the GUI and CandidateFinder.start_review, the results are not final
+            self.error = e
+
+    def _example(self, tokens, pos, n) -> str:
+        window = self.finder.window
+        return ' '.join(tokens[max(pos - window, 0):pos + n + window])
+
+    def _search(self):
+        counts, contexts = Counter(), {}
+        for i, record in enumerate(self.finder.records, 1):
+            if self._stop.is_set():
+                return
+            for candidate, _, line, pos in self.finder._record_candidates(record):
+                counts[candidate] += 1
+                examples = contexts.setdefault(candidate, [])
+                if len(examples) < self.examples:
+                    examples.append(self._example(record.tokens[line], pos, len(candidate)))
+
+            if i % self.chunk_size == 0:
+                self._update(counts, contexts)
+                counts, contexts = Counter(), {}
+
+        self._update(counts, contexts)
+
+    def _find_examples(self):
+        # candidates with an unknown count are searched until all example contexts are found
+        missing = {c: min(self.examples, n) if n is not None else self.examples for c, n in self.counts.items()}
+        mxn = max((len(c) for c in missing), default=0)
+        for record in self.finder.records:
+            if self._stop.is_set() or not missing:
+                return
+            for ln, line in enumerate(record.tokens):
+                for pos in range(len(line)):
+                    for n in range(1, min(mxn, len(line) - pos) + 1):
+                        candidate = tuple(line[pos:pos + n])
+                        if candidate in missing:
+                            with self._lock:
+                                examples = self.contexts.setdefault(candidate, [])
+                                examples.append(self._example(line, pos, n))
+                            if len(examples) >= missing[candidate]:
+                                del missing[candidate]
+
+    def _needed(self, candidate) -> int:
+        """
+        :return: number of example contexts that can be found for a given candidate, a candidate with an unknown
+            count is expected to occur at least once
+        """
+        count = self.counts[candidate]
+        return min(self.examples, count if count is not None else 1)
+
+    def _update(self, counts, contexts):
+        with self._lock:
+            self.counts.update(counts)
+            for candidate, examples in contexts.items():
+                cur = self.contexts.setdefault(candidate, [])
+                cur.extend(examples[:self.examples - len(cur)])
+
+    def ranking(self, exclude=()) -> list:
+        """
+        :param exclude: candidates to leave out, lexicon entries are always left out
+        :return: list of (candidate, count) tuples of the candidates found so far, ordered by their occurrence count,
+            given candidates keep their order
+        """
+        if self.given:
+            return [(c, self.counts[c]) for c in self.order if c not in exclude and c not in self.finder.lexicon]
 
-    def load_all(self):
-        self.load_lexicon()
-        self.load_pos_stats()
-        self.load_rejected()
+        with self._lock:
+            counts = [(c, n) for c, n in self.counts.items() if c not in exclude and c not in self.finder.lexicon]
+
+        return sorted(counts, key=itemgetter(1), reverse=True)
+
+    def top(self, n, exclude=()) -> list:
+        """
+        :param n: number of candidates
+        :param exclude: candidates to leave out, lexicon entries are always left out
+        :return: list of (candidate, example contexts) tuples of the n most frequent candidates found so far, or the
+            first n given candidates
+        """
+        with self._lock:
+            if self.given:
+                top = islice((c for c in self.order if c not in exclude and c not in self.finder.lexicon), n)
+            else:
+                top = (c for c, _ in nlargest(n, ((c, k) for c, k in self.counts.items() if c not in exclude and
+                                                  c not in self.finder.lexicon), key=itemgetter(1)))
+            return [(c, list(self.contexts.get(c, ()))) for c in top]
+
+    def prefetch(self, n, exclude=()):
+        """
+        Request the next batch of candidates in the background, see top.
+        The batch is ready when it will not change anymore: the search is finished (or failed), or the batch is full
+        and, for given candidates, all example contexts that can be found have been found.
+
+        :return: Future that resolves to a (batch ready, list returned by top) tuple
+        """
+        return self._executor.submit(self._batch, n, set(exclude))
+
+    def _batch(self, n, exclude):
+        done = self.done or self.error is not None  # read first, the batch is final if the search had already ended
+        batch = self.top(n, exclude)
+        full = len(batch) == n and (not self.given or all(len(e) >= self._needed(c) for c, e in batch))
+
+        return done or full, batch
+
+    def stop(self):
+        """
+        Stop the search, e.g. because the contexts or lexicon of the finder changed, and release the prefetch worker.
+        """
+        self._stop.set()
+        self._executor.shutdown(wait=False)
+
+    def join(self, timeout=None):
+        """
+        Wait until all candidates have been found.
+        """
+        self._thread.join(timeout)
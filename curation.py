@@ -1,10 +1,10 @@
-from data_utils import get_wd, LexiconEntry, Tag
-import pickle
+from data_utils import get_wd, LexiconEntry, Tag, AnnotationStore, get_annotation_store
 from extraction import extract_all
+import numpy as np
 
 
 def get_false_positives(records, lexicon, pos_counter=None, pos_counter_m=None, new_entry=None, mode='soft',
-                        path=get_wd() + '/data/annotated.pickle'):
+                        path=get_wd() + '/data/annotated.db', tags=None):
     """
     Finds all false positives for the given lexicon in the given annotated dataset.
 
@@ -19,11 +19,12 @@ def get_false_positives(records, lexicon, pos_counter=None, pos_counter_m=None,
     :param pos_counter_m: positional token counter for match contexts
     :param new_entry: new lexicon entry to check for false positives
     :param mode: soft or hard
-    :param path: annotation file location
+    :param path: annotation store location
+    :param tags: annotations to compare against, defaults to the (cached) annotation store at path
     :return: list of (false positive, record id, (line, position), context) tuples
     """
-    with open(path, 'rb') as file:
-        tags = pickle.load(file)
+    if tags is None:
+        tags = get_annotation_store(path)
 
     lexicon = lexicon.copy()
     if new_entry:
@@ -39,43 +40,116 @@ def get_false_positives(records, lexicon, pos_counter=None, pos_counter_m=None,
 
     records = [r for r in records if r.id in tags]
     for r in records:
-        r.tags = {}
+        r.tags.clear()
 
     extract_all(records, lexicon, pos_counter=pos_counter, pos_counter_m=pos_counter_m)
     fps = []
-    for record, tag in ((record, tags[record.id]) for record in records if record.id in tags):
-        for (l, p) in record.tags:
+    for record in records:
+        _, fp, _ = compare_tags(record, tags[record.id], mode=mode)
+        for l, p in record.tags.positions(np.flatnonzero(fp)):
             if record.tokens[l][p]:
-                if (l, p) not in tag:
-                    if mode == 'soft':
-                        if p - 1 >= 0 and (l, p - 1) in tag:
-                            continue
-                    fps.append((record.tokens[l][p], record.id, (l, p), record.tokens[l][p-3:p+4]))
+                fps.append((record.tokens[l][p], record.id, (l, p), record.tokens[l][p-3:p+4]))
 
     return fps
 
 
-def mark_ambiguous(lexicon, entry):
-    lexicon[entry].class_ = Tag.AMB
+def compare_tags(record, annotations, mode='soft') -> tuple:
+    """
+    Compare the extracted tags of a record with its annotations, see get_false_positives for the modes.
+
+    :param record: record object
+    :param annotations: iterable of annotated (line, position) tuples
+    :param mode: soft or hard
+    :return: (true positive, false positive, false negative) boolean arrays aligned to the flattened tokens
+    """
+    return compare_masks(record.tags.codes != 0, record.tags.mask(annotations), record.tags.offsets[:-1], mode=mode)
+
+
+def compare_masks(predicted, gold, starts, mode='soft') -> tuple:
+    """
+    Compare predicted and annotated token masks, see get_false_positives for the modes.
+
+    :param predicted: boolean array of predicted tokens
+    :param gold: boolean array of annotated tokens
+    :param starts: flat token offsets of the line starts
+    :param mode: soft or hard
+    :return: (true positive, false positive, false negative) boolean arrays
+    """
+    fp = predicted & ~gold
+    if mode == 'soft':
+        # ignore false positives directly following an annotated token on the same line
+        prev = np.zeros_like(gold)
+        prev[1:] = gold[:-1]
+        prev[starts[starts < len(prev)]] = False
+        fp &= ~prev
+
+    return predicted & gold, fp, gold & ~predicted
 
 
-def get_tags(path=get_wd() + '/data/annotated.pickle'):
-    with open(path, 'rb') as file:
-        return pickle.load(file)
+def count_matches(records, tags, mode='soft') -> tuple:
+    """
+    Count the matches between the extracted tags and the annotations of all annotated records.
 
+    :param records: records to check
+    :param tags: annotations, e.g. an AnnotationStore
+    :param mode: soft or hard
+    :return: (true positives, false positives, false negatives) tuple
+    """
+    tp = fp = fn = 0
+    for record in records:
+        if record.id in tags:
+            t, f, n = compare_tags(record, tags[record.id], mode=mode)
+            tp += int(np.count_nonzero(t))
+            fp += int(np.count_nonzero(f))
+            fn += int(np.count_nonzero(n))
 
-def save_tags(tags, path=get_wd() + '/data/annotated.pickle'):
-    with open(path, 'wb') as file:
-        pickle.dump(tags, file)
+    return tp, fp, fn
 
 
-def remove_tag(tags, id, pos, save=True):
-    del tags[id][pos]
-    if save:
-        save_tags(tags)
+def mark_ambiguous(lexicon, entry):
+    lexicon[entry].class_ = Tag.AMB
 
 
-def add_tag(tags, id, pos, save=True):
-    tags[id][pos] = True
-    if save:
-        save_tags(tags)
+def get_tags(path=get_wd() + '/data/annotated.db'):
+    """
+    :param path: annotation store location
+    :return: AnnotationStore mapping record ids to {(line, position): True} dictionaries
+    """
+    return get_annotation_store(path)
+
+
+def save_tags(tags, path=get_wd() + '/data/annotated.db'):
+    """
+    Write annotations to the annotation store, only the records contained in tags are replaced.
+
+    :param tags: AnnotationStore, or {record id: {(line, position): tag}} dictionary
+    :param path: annotation store location
+    """
+    if isinstance(tags, AnnotationStore):
+        tags.flush()
+    else:
+        store = get_annotation_store(path)
+        store.update(tags)
+        store.flush()
+
+
+def remove_tag(tags, id, pos, save=True, path=get_wd() + '/data/annotated.db'):
+    if isinstance(tags, AnnotationStore):
+        tags.remove_tag(id, pos)
+        if save:
+            tags.flush()
+    else:
+        del tags[id][pos]
+        if save:
+            save_tags({id: tags[id]}, path=path)
+
+
+def add_tag(tags, id, pos, save=True, path=get_wd() + '/data/annotated.db'):
+    if isinstance(tags, AnnotationStore):
+        tags.add_tag(id, pos)
+        if save:
+            tags.flush()
+    else:
+        tags[id][pos] = True
+        if save:
+            save_tags({id: tags[id]}, path=path)
@@ -1,7 +1,11 @@
 import pickle
 import os
+import sqlite3
+from collections.abc import Mapping, MutableMapping
+from itertools import count
 from typing import List
 from nltk import word_tokenize
+import numpy as np
 import re
 
 P = re.compile(r'(\d+)')  # regex for masking numbers
@@ -45,6 +49,8 @@ class Tag:
     REG = 'regular'
     AMB = 'ambiguous'
     FUZ = 'fuzzy'
+    CLASSES = (None, REG, FUZ, AMB)  # tag class per tag array code, 0 means not tagged
+    CODES = {REG: 1, FUZ: 2, AMB: 3}
 
     def __init__(self, line, idx, token, class_=REG):
         """
@@ -64,8 +70,90 @@ class Tag:
         return f'({self.line},{self.id}): {self.token} - {self.class_}'
 
 
+class TagArray(MutableMapping):
+    __slots__ = 'tokens', 'offsets', 'codes'
+
+    def __init__(self, tokens):
+        """
+        Array-backed tags of a record, behaves like a {(line, position): Tag} dictionary.
+        Tag classes are kept as codes (see Tag.CODES) in an array aligned to the flattened token positions.
+
+        :param tokens: list of lists of tokens of the record
+        """
+        self.tokens = tokens
+        self.offsets = np.cumsum([0] + [len(line) for line in tokens])
+        self.codes = np.zeros(self.offsets[-1], dtype=np.int8)
+
+    def index(self, line, pos):
+        """
+        :return: flat token offset of the given position, None if it is out of range
+        """
+        if 0 <= line < len(self.tokens) and 0 <= pos < len(self.tokens[line]):
+            return self.offsets[line] + pos
+
+        return None
+
+    def positions(self, indices) -> list:
+        """
+        :param indices: array of flat token offsets
+        :return: list of (line, position) tuples
+        """
+        lines = np.searchsorted(self.offsets, indices, side='right') - 1
+        return list(zip(lines.tolist(), (indices - self.offsets[lines]).tolist()))
+
+    def mask(self, positions):
+        """
+        :param positions: iterable of (line, position) tuples, e.g. the annotations of this record
+        :return: boolean array aligned to the flattened tokens, True at the given positions
+        """
+        mask = np.zeros(len(self.codes), dtype=bool)
+        positions = np.array(list(positions), dtype=np.int64).reshape(-1, 2)
+        lines, pos = positions[:, 0], positions[:, 1]
+        valid = (lines >= 0) & (lines < len(self.tokens)) & (pos >= 0)
+        lines, pos = lines[valid], pos[valid]
+        valid = pos < np.diff(self.offsets)[lines]
+        mask[self.offsets[lines[valid]] + pos[valid]] = True
+
+        return mask
+
+    def __getitem__(self, key):
+        idx = self.index(*key)
+        if idx is None or not self.codes[idx]:
+            raise KeyError(key)
+
+        return Tag(key[0], key[1], self.tokens[key[0]][key[1]], Tag.CLASSES[self.codes[idx]])
+
+    def __setitem__(self, key, value):
+        idx = self.index(*key)
+        if idx is None:
+            raise KeyError(key)
+        self.codes[idx] = Tag.CODES[value.class_ if isinstance(value, Tag) else Tag.REG]
+
+    def __delitem__(self, key):
+        idx = self.index(*key)
+        if idx is None or not self.codes[idx]:
+            raise KeyError(key)
+        self.codes[idx] = 0
+
+    def __contains__(self, key):
+        idx = self.index(*key)
+        return idx is not None and bool(self.codes[idx])
+
+    def __iter__(self):
+        return iter(self.positions(np.flatnonzero(self.codes)))
+
+    def __len__(self):
+        return int(np.count_nonzero(self.codes))
+
+    def clear(self):
+        self.codes[:] = 0
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 class Record:
-    __slots__ = 'id', 'tokens', 'tags', 'numbers'
+    __slots__ = 'id', 'tokens', 'tags', 'numbers', 'view'
 
     def __init__(self, id_, text, tokenizer=word_tokenize):
         """
@@ -78,7 +166,23 @@ class Record:
         """
         self.id = id_
         self.numbers, self.tokens = tokenize(text, tokenizer=tokenizer)
-        self.tags = {}
+        self.tags = TagArray(self.tokens)
+        self.view = None  # cached lexicon-masked view, see context_utils.get_masked_view
+
+    def __getstate__(self):
+        # the masked view is a cache, don't pickle it
+        return None, {s: getattr(self, s) for s in ('id', 'tokens', 'tags', 'numbers')}
+
+    def __setstate__(self, state):
+        for slot, value in state[1].items():
+            setattr(self, slot, value)
+        self.view = None
+
+        # records pickled by earlier versions keep their tags in a {(line, position): Tag} dictionary
+        if not isinstance(self.tags, TagArray):
+            tags = TagArray(self.tokens)
+            tags.update(self.tags)
+            self.tags = tags
 
     def get_tag(self, line, idx):
         if (line, idx) in self.tags:
@@ -134,6 +238,206 @@ class LexiconEntry:
         return self.raw
 
 
+class Lexicon(dict):
+    _versions = count()
+
+    def __init__(self, *args, **kwargs):
+        """
+        Lexicon dictionary, {(tokens): LexiconEntry}.
+        Keeps a version number that changes on every modification so derived data can be cached per lexicon version.
+        Version numbers are unique across all lexicon instances.
+        """
+        super().__init__(*args, **kwargs)
+        self.version = next(self._versions)
+
+    def _modified(self):
+        self.version = next(self._versions)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._modified()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._modified()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._modified()
+
+    def __ior__(self, other):
+        super().__ior__(other)
+        self._modified()
+        return self
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._modified()
+        return super().setdefault(key, default)
+
+    def pop(self, *args):
+        self._modified()
+        return super().pop(*args)
+
+    def popitem(self):
+        self._modified()
+        return super().popitem()
+
+    def clear(self):
+        super().clear()
+        self._modified()
+
+    def copy(self):
+        return Lexicon(self)
+
+    def __reduce__(self):
+        # versions are only meaningful within a session, a loaded lexicon gets a fresh one
+        return Lexicon, (dict(self),)
+
+
+class AnnotationStore(Mapping):
+    def __init__(self, path=get_wd() + '/data/annotated.db', batch_size=100):
+        """
+        Annotation store backed by an SQLite file, maps record ids to {(line, position): True} dictionaries.
+        Records are read on first access and cached in memory. Edits are applied to the cache immediately and
+        written in batches of batch_size operations, every batch in a single transaction.
+
+        :param path: database file location
+        :param batch_size: number of pending edits that triggers a write
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS records (id PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS tags (record, line INTEGER, pos INTEGER, PRIMARY KEY (record, line, pos));
+        ''')
+        self._ids = {rid for rid, in self._conn.execute('SELECT id FROM records')}
+        self._cache = {}
+        self._pending = []
+
+    def __getitem__(self, record_id):
+        if record_id not in self._ids:
+            raise KeyError(record_id)
+        if record_id not in self._cache:
+            rows = self._conn.execute('SELECT line, pos FROM tags WHERE record = ?', (record_id,))
+            self._cache[record_id] = {(line, pos): True for line, pos in rows}
+
+        return self._cache[record_id]
+
+    def __contains__(self, record_id):
+        return record_id in self._ids
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _queue(self, *ops):
+        self._pending.extend(ops)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def _annotate(self, record_id):
+        if record_id not in self._ids:
+            self._ids.add(record_id)
+            self._cache[record_id] = {}
+            self._queue(('INSERT OR IGNORE INTO records VALUES (?)', (record_id,)))
+
+    def set_record(self, record_id, tags):
+        """
+        Mark a record as annotated and replace its annotated tokens.
+
+        :param record_id: record id
+        :param tags: iterable of (line, position) tuples, e.g. a Record.tags dictionary
+        """
+        self._annotate(record_id)
+        self._cache[record_id] = {pos: True for pos in tags}
+        self._queue(('DELETE FROM tags WHERE record = ?', (record_id,)),
+                    *(('INSERT OR IGNORE INTO tags VALUES (?, ?, ?)', (record_id, line, pos))
+                      for line, pos in self._cache[record_id]))
+
+    def add_tag(self, record_id, pos):
+        self._annotate(record_id)
+        self[record_id][pos] = True
+        self._queue(('INSERT OR IGNORE INTO tags VALUES (?, ?, ?)', (record_id, *pos)))
+
+    def remove_tag(self, record_id, pos):
+        del self[record_id][pos]
+        self._queue(('DELETE FROM tags WHERE record = ? AND line = ? AND pos = ?', (record_id, *pos)))
+
+    def update(self, tags):
+        """
+        Replace the annotations of all records in the given {record id: {(line, position): tag}} dictionary.
+        """
+        for record_id, record_tags in tags.items():
+            self.set_record(record_id, record_tags)
+
+    def flush(self):
+        """
+        Write all pending edits in a single transaction.
+        """
+        if not self._pending:
+            return
+        with self._conn:
+            for query, args in self._pending:
+                self._conn.execute(query, args)
+        self._pending.clear()
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+        _stores.pop(os.path.realpath(self.path), None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_stores = {}
+
+
+def get_annotation_store(path=get_wd() + '/data/annotated.db', legacy_path=None):
+    """
+    Get the annotation store for the given file, every file is only opened once per session so the cache is shared.
+    A new store is populated from the pickle file written by earlier versions, if it exists.
+
+    :param path: database file location
+    :param legacy_path: pickled {record id: {(line, position): tag}} annotations to import into a new store, defaults
+        to the pickle file next to the database (data/annotated.pickle for the default store), False to skip the import
+    :return: AnnotationStore object
+    """
+    key = os.path.realpath(path)
+    if key not in _stores:
+        if legacy_path is None:
+            legacy_path = os.path.splitext(path)[0] + '.pickle'
+        legacy = None
+        if not os.path.exists(path) and legacy_path and os.path.exists(legacy_path):
+            # read the old annotations before the database file exists, a failed import is retried on the next open
+            with open(legacy_path, 'rb') as file:
+                legacy = pickle.load(file)
+
+        store = AnnotationStore(path)
+        if legacy is not None:
+            try:
+                store.update(legacy)
+                store.flush()
+            except Exception:
+                store._pending.clear()
+                store.close()
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+                raise
+        _stores[key] = store
+
+    return _stores[key]
+
+
 def records_from_pickle(path=get_wd() + '/data/records.pickle'):
     """
     Load records as saved by the Records.save function.
@@ -154,9 +458,9 @@ def build_lexicon(path=get_wd() + '/data/lexicon.txt', tokenizer=word_tokenize,
     :param path: text file location
     :param tokenizer: tokenization function
     :param encoding: text file encoding
-    :return: {(tokens): LexiconEntry} dictionary
+    :return: {(tokens): LexiconEntry} Lexicon dictionary
     """
-    lexicon = {}
+    lexicon = Lexicon()
     with open(path, 'r', encoding=encoding) as file:
         for line in file.readlines():
             nums = P.findall(line)
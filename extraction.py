@@ -1,10 +1,10 @@
 from data_utils import Tag
-from context_utils import get_at_n
+from context_utils import get_masked_view, get_context
 
 
 def extract_all(records, lexicon, pos_counter=None, pos_counter_m=None, mxn=3, window=3):
     """
-    Extract all matches from the given records using the given lexicon, saved in the records' tag objects.
+    Extract all matches from the given records using the given lexicon, saved in the records' tag arrays.
 
     :param records: list of record objects
     :param lexicon: dictionary of lexicon items
@@ -14,20 +14,23 @@ def extract_all(records, lexicon, pos_counter=None, pos_counter_m=None, mxn=3, w
     :param window: context window size
     """
     for record in records:
+        view = None
+        codes, offsets = record.tags.codes, record.tags.offsets
         for ln, line in enumerate(record.tokens):
             for i, w in enumerate(line):
                 for n in range(mxn - 1, -1, -1):
-                    if (i + n) < len(line) and tuple(line[i + m] for m in range(n + 1)) in lexicon:
-                        toks = tuple(line[i + m] for m in range(n + 1))
-                        if lexicon[tuple(line[i + m] for m in range(n + 1))].class_ == Tag.AMB:
-                            tpl = tuple([get_at_n(record.tokens, ln, i if k < 0 else i + n, k, lexicon) for k in
-                                         range(-window, window + 1) if k != 0])
+                    toks = tuple(line[i:i + n + 1])
+                    if (i + n) < len(line) and toks in lexicon:
+                        if lexicon[toks].class_ == Tag.AMB:
+                            if view is None:
+                                view = get_masked_view(record, lexicon, window)
+                            tpl = get_context(view[ln], i, n, window)
                             # ignore this entry if no positional counters provided
                             if not pos_counter or not pos_counter_m or _score_context(pos_counter, pos_counter_m,
                                                                                       tpl) < 0.01:
                                 continue
-                        for m in range(n + 1):
-                            record.tags[(ln, i + m)] = Tag(ln, i + m, line[i + m], lexicon[toks].class_)
+                        start = offsets[ln] + i
+                        codes[start:start + n + 1] = Tag.CODES[lexicon[toks].class_]
 
 
 def _score_context(pos_counter_m, pos_counter, context) -> float:
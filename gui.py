@@ -1,22 +1,62 @@
 import tkinter as tk
 from tkinter import font
-from data_utils import Tag, get_wd
+from bisect import bisect_right
+from data_utils import Tag, get_annotation_store
 from random import choice
-import pickle
+
+
+class _SpanIndex:
+    def __init__(self):
+        """
+        Sorted index of the spans of text in a Text widget, resolves a widget index to the span containing it by bisection.
+        Spans have to be added in text order.
+        """
+        self.lines = {}
+
+    def add(self, line, start, end, value):
+        """
+        :param line: widget line number
+        :param start: start column
+        :param end: end column (exclusive)
+        :param value: value to return for this span
+        """
+        starts, ends, values = self.lines.setdefault(line, ([], [], []))
+        starts.append(start)
+        ends.append(end)
+        values.append(value)
+
+    def find(self, index):
+        """
+        :param index: widget index as 'line.column'
+        :return: (start index, end index, value) of the span containing the index, None if there is none
+        """
+        line, col = map(int, str(index).split('.'))
+        if line not in self.lines:
+            return None
+        starts, ends, values = self.lines[line]
+        i = bisect_right(starts, col) - 1
+        if i < 0 or col >= ends[i]:
+            return None
+
+        return f'{line}.{starts[i]}', f'{line}.{ends[i]}', values[i]
+
+    def clear(self):
+        self.lines.clear()
 
 
 class AnnotationGUI:
-    def __init__(self, records, filter_=None):
+    def __init__(self, records, filter_=None, store=None):
         """
         GUI for annotating records.
 
         :param records: list of records to annotate
         :param filter_: optional list of record ids to ignore (e.g. if they have already been annotated)
+        :param store: AnnotationStore to save annotations in, defaults to the store in the data folder
         """
         self.records = [r for r in records.copy() if r.id not in filter_] if filter_ else records.copy()
         self.cur = None
-        self.ttt = {}
-        self.annotated = {}
+        self.spans = _SpanIndex()
+        self.annotated = store if store is not None else get_annotation_store()
 
         self.root = tk.Tk()
         custom_font = font.Font(family='Raavi', size=12)
@@ -49,68 +89,75 @@ class AnnotationGUI:
             return
         self.cur = choice(self.records)
         self.records.remove(self.cur)
-        self.ttt.clear()
+        self.spans.clear()
+
+        # insert the whole record at once, with the tag of every token
+        tagged = (self.cur.tags.codes != 0).tolist()
+        chunks = []
+        k = 0
         for ln, line in enumerate(self.cur.tokens):
+            col = 0
             for i, w in enumerate(line):
-                cid = self.text.index(tk.INSERT)
-                if (ln, i) in self.cur.tags:
-                    self.text.insert(tk.END, w, 'mat')
-                else:
-                    self.text.insert(tk.END, w, 'reg')
-                self.ttt[(cid, self.text.index(tk.INSERT))] = (ln, i)
-                self.text.insert(tk.END, ' ')
-            self.text.insert(tk.END, '\n')
-
-    def _save_record(self, path=get_wd() + '/data/annotated.pickle'):
-        if self.cur.id not in self.annotated:
-            self.annotated[self.cur.id] = self.cur.tags
-
-        with open(path, 'wb') as file:
-            pickle.dump(self.annotated, file)
+                chunks += [w, 'mat' if tagged[k] else 'reg', ' ', ()]
+                self.spans.add(ln + 1, col, col + len(w), (ln, i))
+                col += len(w) + 1
+                k += 1
+            chunks += ['\n', ()]
+        if chunks:
+            self.text.insert(tk.END, *chunks)
+
+    def _save_record(self):
+        self.annotated.set_record(self.cur.id, self.cur.tags)
+        self.annotated.flush()
 
     def _callback(self, event):
-        index = event.widget.index("@%s,%s" % (event.x, event.y))
-
-        tag_indices = list(event.widget.tag_ranges('mat'))
-        reg_indices = list(event.widget.tag_ranges('reg'))
-
-        for start, end in zip(tag_indices[0::2], tag_indices[1::2]):
-            if event.widget.compare(start, '<=', index) and event.widget.compare(index, '<', end):
-                self.text.tag_remove('mat', start, end)
-                self.text.tag_add('reg', start, end)
-                del self.cur.tags[self.ttt[(str(start), str(end))]]
+        span = self.spans.find(event.widget.index("@%s,%s" % (event.x, event.y)))
+        if span is None:
+            return
 
-        for start, end in zip(reg_indices[0::2], reg_indices[1::2]):
-            if event.widget.compare(start, '<=', index) and event.widget.compare(index, '<', end):
-                self.text.tag_remove('reg', start, end)
-                self.text.tag_add('mat', start, end)
-                self.cur.tags[self.ttt[(str(start), str(end))]] = True
+        start, end, pos = span
+        if pos in self.cur.tags:
+            self.text.tag_remove('mat', start, end)
+            self.text.tag_add('reg', start, end)
+            del self.cur.tags[pos]
+        else:
+            self.text.tag_remove('reg', start, end)
+            self.text.tag_add('mat', start, end)
+            self.cur.tags[pos] = True
 
 
 class ReviewGUI:
-    def __init__(self, candidates, rejects=None, steps=20):
+    def __init__(self, candidates, rejects=None, steps=20, stream=None, n=None):
         """
         Starts the GUI.
 
         :param candidates: ordered list of candidates to review
         :param rejects: set of rejected candidates from earlier runs
         :param steps: number of candidates on screen at once
+        :param stream: optional CandidateStream to take the candidates (with example contexts) from while it is running
+        :param n: maximum number of candidates to take from the stream
         """
         self.matches = set()
         if not rejects:
             rejects = set()
 
         self._rejects = rejects
-        self.candidates = candidates
+        self.candidates = list(candidates)
+        self.stream = stream
+        self.n = n
+        self._prefetch = None
+        self._waiting = False
+        self.spans = _SpanIndex()
 
         self.root = tk.Tk()
         custom_font = font.Font(family='Raavi', size=12)
         self.top = tk.Frame(self.root)
         self.top.pack(side=tk.TOP)
 
-        self.text = tk.Text(self.root, font=custom_font, width=80, height=10)
+        self.text = tk.Text(self.root, font=custom_font, width=80, height=10 if stream is None else max(10, steps))
         self.text.pack(in_=self.top, side=tk.LEFT, fill=tk.BOTH, expand=True)
 
+        self.text.tag_config('ctx', foreground='gray')
         self.text.tag_config('amb', foreground='purple')
         self.text.tag_bind('amb', "<Button-3>", self._callback)
         self.text.tag_config('mat', foreground='red')
@@ -144,55 +191,104 @@ class ReviewGUI:
 
         :param event: click event
         """
-        index = event.widget.index("@%s,%s" % (event.x, event.y))
-
-        amb_indices = list(event.widget.tag_ranges('amb'))
-        tag_indices = list(event.widget.tag_ranges('mat'))
-        reg_indices = list(event.widget.tag_ranges('reg'))
-
-        # change tag from match to ambiguous
-        for start, end in zip(tag_indices[0::2], tag_indices[1::2]):
-            if event.widget.compare(start, '<=', index) and event.widget.compare(index, '<', end):
-                self.text.tag_remove('mat', start, end)
-                self.text.tag_add('amb', start, end)
-                spl = self.text.get(start, end).split()
-                m = tuple(spl)
-                self.matches.remove((m, Tag.REG))
-                self.matches.add((m, Tag.AMB))
-
-        # change tag from ambiguous to rejected
-        for start, end in zip(amb_indices[0::2], amb_indices[1::2]):
-            if event.widget.compare(start, '<=', index) and event.widget.compare(index, '<', end):
-                self.text.tag_remove('amb', start, end)
-                self.text.tag_add('reg', start, end)
-                spl = self.text.get(start, end).split()
-                m = tuple(spl)
-                self.matches.remove((m, Tag.AMB))
-
-        # change tag from rejected to match
-        for start, end in zip(reg_indices[0::2], reg_indices[1::2]):
-            if event.widget.compare(start, '<=', index) and event.widget.compare(index, '<', end):
-                self.text.tag_remove('reg', start, end)
-                self.text.tag_add('mat', start, end)
-                spl = self.text.get(start, end).split()
-                m = tuple(spl)
-                self.matches.add((m, Tag.REG))
+        span = self.spans.find(event.widget.index("@%s,%s" % (event.x, event.y)))
+        if span is None:
+            return
+
+        start, end, m = span
+        if (m, Tag.REG) in self.matches:
+            # change tag from match to ambiguous
+            self.text.tag_remove('mat', start, end)
+            self.text.tag_add('amb', start, end)
+            self.matches.remove((m, Tag.REG))
+            self.matches.add((m, Tag.AMB))
+        elif (m, Tag.AMB) in self.matches:
+            # change tag from ambiguous to rejected
+            self.text.tag_remove('amb', start, end)
+            self.text.tag_add('reg', start, end)
+            self.matches.remove((m, Tag.AMB))
+        else:
+            # change tag from rejected to match
+            self.text.tag_remove('reg', start, end)
+            self.text.tag_add('mat', start, end)
+            self.matches.add((m, Tag.REG))
 
     def _next_candidates(self, event=None):
         """
-        Load the next
+        Load the next batch of candidates.
 
         :param event: button click event
         """
+        if self.stream is not None:
+            if not self._waiting:
+                self._next_from_stream()
+            return
+
+        batch = self.candidates[self.cur:self.cur + self.steps]
+        self.cur += len(batch)
+        self._show([(candidate, None) for candidate in batch])
+
+    def _next_from_stream(self):
+        """
+        Show the prefetched batch of candidates from the stream and prefetch the next one.
+        Waits without blocking the GUI while the batch is not ready, see CandidateStream.prefetch.
+        """
+        limit = self.steps if self.n is None else min(self.steps, self.n - self.cur)
+        if limit <= 0:
+            self.text.delete('1.0', tk.END)
+            return
+
+        if self._prefetch is None:
+            self._prefetch = self.stream.prefetch(limit, self._rejects.union(self.candidates))
+        if self._prefetch.done():
+            ready, batch = self._prefetch.result()
+            if self.stream.error is not None:
+                self._waiting = False
+                self.text.delete('1.0', tk.END)
+                self.text.insert(tk.END, f'Candidate search failed: {self.stream.error!r}', 'ctx')
+                return
+            if not ready:
+                # the search is still running, ask again
+                self._prefetch = None
+        if self._prefetch is None or not self._prefetch.done():
+            if not self._waiting:
+                self.text.delete('1.0', tk.END)
+                self.text.insert(tk.END, 'Searching candidates...', 'ctx')
+            self._waiting = True
+            self.root.after(100, self._next_from_stream)
+            return
+
+        self._waiting = False
+        self.candidates.extend(c for c, _ in batch)
+        self.cur += len(batch)
+        self._show(batch)
+
+        limit = self.steps if self.n is None else min(self.steps, self.n - self.cur)
+        self._prefetch = self.stream.prefetch(limit, self._rejects.union(self.candidates)) if limit > 0 else None
+
+    def _show(self, batch):
+        """
+        Replace the shown candidates, in a single insert.
+        Candidates without example contexts are shown on one line, others on a line each followed by their examples.
+
+        :param batch: list of (candidate, example contexts or None) tuples
+        """
         self.text.delete('1.0', tk.END)
-        for i in range(self.cur, self.cur + self.steps):
-            if len(self.candidates) > i:
-                self.text.index(tk.INSERT)
-                self.text.insert(tk.END, self.candidates[i], 'reg')
-                self.text.insert(tk.END, ', ')
-                self.cur += 1
+        self.spans.clear()
+        chunks = []
+        line, col = 1, 0
+        for candidate, examples in batch:
+            text = ' '.join(candidate)
+            chunks += [text, 'reg']
+            self.spans.add(line, col, col + len(text), candidate)
+            if examples is None:
+                chunks += [', ', ()]
+                col += len(text) + 2
             else:
-                break
+                chunks += ['  ' + ' | '.join(examples) + '\n', 'ctx']
+                line += 1
+        if chunks:
+            self.text.insert(tk.END, *chunks)
 
 
 if __name__ == '__main__':
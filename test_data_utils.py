@@ -0,0 +1,57 @@
+import pickle
+
+import pytest
+
+from context_utils import get_masked_view
+from data_utils import Lexicon, Record
+
+MUTATORS = [
+    ('setitem', lambda lex: lex.__setitem__(('c',), 3)),
+    ('delitem', lambda lex: lex.__delitem__(('a',))),
+    ('update', lambda lex: lex.update({('c',): 3})),
+    ('ior', lambda lex: lex.__ior__({('c',): 3})),
+    ('setdefault', lambda lex: lex.setdefault(('c',), 3)),
+    ('pop', lambda lex: lex.pop(('a',))),
+    ('popitem', lambda lex: lex.popitem()),
+    ('clear', lambda lex: lex.clear()),
+]
+
+
+@pytest.mark.parametrize('name, mutate', MUTATORS, ids=[m[0] for m in MUTATORS])
+def test_lexicon_mutators_change_version(name, mutate):
+    lex = Lexicon({('a',): 1, ('b',): 2})
+    version = lex.version
+    mutate(lex)
+    assert lex.version != version
+
+
+def test_lexicon_inplace_or_operator():
+    lex = Lexicon({('a',): 1})
+    version = lex.version
+    lex |= {('b',): 2}
+    assert isinstance(lex, Lexicon)
+    assert lex.version != version
+    assert ('b',) in lex
+
+
+def test_lexicon_setdefault_existing_key_keeps_version():
+    lex = Lexicon({('a',): 1})
+    version = lex.version
+    assert lex.setdefault(('a',), 2) == 1
+    assert lex.version == version
+
+
+def test_lexicon_versions_unique_across_copies_and_pickles():
+    lex = Lexicon({('a',): 1})
+    versions = {lex.version, lex.copy().version, pickle.loads(pickle.dumps(lex)).version}
+    assert len(versions) == 3
+
+
+def test_masked_view_invalidated_on_lexicon_change():
+    record = Record(0, 'aa bb cc')
+    lex = Lexicon({'bb': 1})
+    assert get_masked_view(record, lex, window=1)[0] == ['', 'aa', 'M', 'cc', '']
+    lex |= {'cc': 1}
+    assert get_masked_view(record, lex, window=1)[0] == ['', 'aa', 'M', 'M', '']
+    del lex['bb']
+    assert get_masked_view(record, lex, window=1)[0] == ['', 'aa', 'bb', 'M', '']
@@ -0,0 +1,185 @@
+from collections import Counter
+
+import numpy as np
+
+from context_utils import get_masked_view, get_context
+from curation import compare_masks
+from data_utils import get_wd, get_annotation_store, Tag
+
+
+def sweep(finder, thresholds=(0.25,), partials=(0.25,), min_counts=(1,), windows=None, fuzzy=None, mode='soft',
+          tags=None, path=get_wd() + '/data/annotated.db') -> list:
+    """
+    Evaluate a grid of candidate finder settings with a single pass over the records.
+    The contexts are collected once for the widest window, smaller windows are projected from them.
+    Every configuration gets the number of contexts and candidates that CandidateFinder.process_contexts and
+    CandidateFinder.get_candidates would find, and the precision and recall on the annotated records of extracting
+    the (extended) lexicon plus all candidates. Ambiguous lexicon entries are left out of the evaluation.
+    The finder and its lexicon are not modified.
+
+    :param finder: CandidateFinder object
+    :param thresholds: certainty thresholds to evaluate
+    :param partials: partial match thresholds to evaluate
+    :param min_counts: minimum context occurrence counts to evaluate
+    :param windows: context window sizes to evaluate, defaults to the window of the finder
+    :param fuzzy: (thresh, pmi_thresh, multi_thresh) extend_fuzzy settings to evaluate, None to use the lexicon as is
+    :param mode: soft or hard, see curation.get_false_positives
+    :param tags: annotations, defaults to the (cached) annotation store at path
+    :param path: annotation store location
+    :return: list of result dictionaries, one per configuration
+    """
+    if tags is None:
+        tags = get_annotation_store(path)
+    windows = sorted(set(windows or (finder.window,)))
+    width = windows[-1]
+    settings = list(fuzzy) if fuzzy else [None]
+
+    # union of the lexicon extensions of all fuzzy settings
+    base = finder.lexicon
+    extensions = [finder.get_fuzzy_entries(*setting) if setting else {} for setting in settings]
+    lexicon = dict(base)
+    for extension in extensions:
+        lexicon.update(extension)
+    entry_ids = {entry: i for i, entry in enumerate(lexicon)}
+    in_lexicon = np.zeros((len(settings), len(entry_ids)), dtype=bool)
+    in_lexicon[:, [entry_ids[entry] for entry in base]] = True
+    for s, extension in enumerate(extensions):
+        in_lexicon[s, [entry_ids[entry] for entry in extension]] = True
+
+    rows = {}  # widest context -> row
+    gc = Counter()  # global context counter
+    matches = Counter()  # (row, lexicon entry) counter
+    found = Counter()  # (row, candidate) counter
+    candidate_ids = {}
+    span_occurrences = []  # (offset, length, tokens) of spans not in the lexicon in annotated records
+    entry_occurrences = []  # (offset, length, lexicon entry) in annotated records
+    gold, starts = [], []
+    total = 0
+    for record in finder.records:
+        tokens = record.tokens
+        view = get_masked_view(record, base, width)
+        annotated = record.id in tags
+        if annotated:
+            offsets = record.tags.offsets + total
+            gold.append(record.tags.mask(tags[record.id]))
+            starts.append(offsets[:-1])
+            total = offsets[-1]
+
+        for ln, line in enumerate(tokens):
+            for i, w in enumerate(line):
+                for l in range(3):
+                    # same spans as process_contexts and get_candidates
+                    if i + l >= len(line) or len(line[i + l]) < 2:
+                        break
+                    toks = tuple(line[i:i + l + 1])
+                    row = rows.setdefault(get_context(view[ln], i, l, width), len(rows))
+                    gc[row] += 1
+                    if toks in lexicon:
+                        matches[(row, entry_ids[toks])] += 1
+                    if toks not in base and w not in base:
+                        candidate = candidate_ids.setdefault(toks, len(candidate_ids))
+                        found[(row, candidate)] += 1
+
+                # same spans as extract_all
+                if annotated:
+                    for n in range(3):
+                        toks = tuple(line[i:i + n + 1])
+                        if i + n >= len(line):
+                            break
+                        if toks in lexicon and lexicon[toks].class_ != Tag.AMB:
+                            entry_occurrences.append((offsets[ln] + i, n + 1, entry_ids[toks]))
+                        if toks not in base:
+                            span_occurrences.append((offsets[ln] + i, n + 1, toks))
+
+    candidate_in_lexicon = np.zeros((len(settings), len(candidate_ids)), dtype=bool)
+    for s, extension in enumerate(extensions):
+        candidate_in_lexicon[s, [candidate_ids[e] for e in extension if e in candidate_ids]] = True
+
+    vocab = {}
+    contexts = np.array([[vocab.setdefault(t, len(vocab)) for t in c] for c in rows],
+                        dtype=np.int64).reshape(-1, 2 * width)
+    gc = np.array([gc[row] for row in range(len(rows))], dtype=np.float64)
+    match_rows, match_entries, match_counts = _to_arrays(matches)
+    found_rows, found_candidates, found_counts = _to_arrays(found)
+    candidate_occurrences = np.array([(o, n, candidate_ids[t]) for o, n, t in span_occurrences if t in candidate_ids],
+                                     dtype=np.int64).reshape(-1, 3)
+    entry_occurrences = np.array(entry_occurrences, dtype=np.int64).reshape(-1, 3)
+    gold = np.concatenate(gold) if gold else np.zeros(0, dtype=bool)
+    starts = np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)
+
+    results = []
+    for window in windows:
+        # project the widest contexts onto this window
+        projected = contexts[:, width - window:width + window]
+        unique, inverse = np.unique(projected, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        gc_w = np.bincount(inverse, weights=gc, minlength=len(unique))
+        pos_counter = [np.bincount(unique[:, j], minlength=len(vocab)) for j in range(2 * window)]
+
+        for s, setting in enumerate(settings):
+            selected = in_lexicon[s, match_entries]
+            contexts_w = np.bincount(inverse[match_rows[selected]], weights=match_counts[selected],
+                                     minlength=len(unique))
+            matched = contexts_w > 0
+            for thresh in thresholds:
+                for min_count in min_counts:
+                    # same filters as process_contexts
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        kept = (matched & (contexts_w / gc_w > thresh) & (contexts_w != gc_w) &
+                                (contexts_w >= min_count))
+                    score = np.zeros(len(unique))
+                    for j in range(2 * window):
+                        pos_counter_m = np.bincount(unique[kept, j], minlength=len(vocab))
+                        score += pos_counter_m[unique[:, j]] / pos_counter[j][unique[:, j]]
+                    score /= 6
+
+                    for partial in partials:
+                        filtered = kept | (~matched & (score > partial))
+                        selected = filtered[inverse[found_rows]] & ~candidate_in_lexicon[s, found_candidates]
+                        # all occurrences of the candidates are extracted once they are added to the lexicon
+                        accepted = np.zeros(len(candidate_ids), dtype=bool)
+                        accepted[found_candidates[selected]] = True
+                        tp, fp, fn = _evaluate(gold, starts, mode,
+                                               candidate_occurrences[accepted[candidate_occurrences[:, 2]]],
+                                               entry_occurrences[in_lexicon[s, entry_occurrences[:, 2]]])
+                        results.append({
+                            'window': window,
+                            'fuzzy': setting,
+                            'thresh': thresh,
+                            'partial': partial,
+                            'min_count': min_count,
+                            'contexts': int(np.count_nonzero(filtered)),
+                            'candidates': len(np.unique(found_candidates[selected])),
+                            'occurrences': int(found_counts[selected].sum()),
+                            'precision': tp / (tp + fp) if tp + fp else 0.,
+                            'recall': tp / (tp + fn) if tp + fn else 0.,
+                        })
+
+    return results
+
+
+def _to_arrays(counter) -> tuple:
+    """
+    :param counter: {(row, id): count} counter
+    :return: row, id and count arrays
+    """
+    keys = np.array(list(counter.keys()), dtype=np.int64).reshape(-1, 2)
+    return keys[:, 0], keys[:, 1], np.array(list(counter.values()), dtype=np.float64)
+
+
+def _evaluate(gold, starts, mode, *occurrences) -> tuple:
+    """
+    Count true positives, false positives, and false negatives of the tokens covered by the given occurrences.
+
+    :param gold: boolean array of annotated tokens
+    :param starts: flat token offsets of the line starts
+    :param mode: soft or hard
+    :param occurrences: arrays with the flat token offset and the length of a span as the first two columns
+    :return: (true positives, false positives, false negatives) tuple
+    """
+    predicted = np.zeros_like(gold)
+    for occ in occurrences:
+        for m in range(3):
+            predicted[occ[occ[:, 1] > m, 0] + m] = True
+
+    return tuple(int(np.count_nonzero(a)) for a in compare_masks(predicted, gold, starts, mode=mode))